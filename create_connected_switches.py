@@ -1,11 +1,24 @@
 import ipaddress
 import uuid
+from functools import lru_cache
 
+from django.db import transaction
 from nautobot.apps.jobs import Job, ObjectVar, BooleanVar, register_jobs
 from nautobot.dcim.models import Device, DeviceType, Location, Interface, Cable
 from nautobot.extras.models import Status, Role
 from nautobot.ipam.models import Prefix, IPAddress
 
+# Parent prefix that switch interconnection /31s are allocated from.
+_PARENT_PREFIX_STR = "10.0.0.0/8"
+_PARENT_NETWORK = ipaddress.IPv4Network(_PARENT_PREFIX_STR)
+
+
+@lru_cache(maxsize=None)
+def _status(name):
+    """Return the Status with the given name, cached for the lifetime of the worker process."""
+    return Status.objects.get(name=name)
+
+
 class CreateSwitchPair(Job):
     """
     Creates two switches using the provided location, device type, and device role.
@@ -52,101 +65,122 @@ class CreateSwitchPair(Job):
 
     def run(self, *, location, device_type, device_role, debug):
         # Retrieve the "Active" status from Nautobot.
-        active_status = Status.objects.get(name="Active")
+        active_status = _status("Active")
         if debug:
             self.logger.debug("Active status retrieved: %s", active_status)
 
-        # Generate unique names for the devices.
-        device_name1 = f"switch1-{uuid.uuid4().hex[:6]}"
-        device_name2 = f"switch2-{uuid.uuid4().hex[:6]}"
-        if debug:
-            self.logger.debug("Generated device names: %s, %s", device_name1, device_name2)
-
-        # Create two switch devices.
-        switch1 = Device(
-            name=device_name1,
-            device_type=device_type,
-            role=device_role,
-            location=location,
-            status=active_status,
-        )
-        switch1.validated_save()
-        self.logger.info("Created device", extra={"object": switch1})
-        if debug:
-            self.logger.debug(
-                "Switch1 created with device_type=%s, role=%s, location=%s",
-                device_type, device_role, location
+        # Perform every write in a single transaction so the database commits once,
+        # and a failure part-way through leaves nothing behind.
+        with transaction.atomic():
+            # Generate unique names for the devices.
+            device_name1 = f"switch1-{uuid.uuid4().hex[:6]}"
+            device_name2 = f"switch2-{uuid.uuid4().hex[:6]}"
+            if debug:
+                self.logger.debug("Generated device names: %s, %s", device_name1, device_name2)
+
+            # Create two switch devices. validated_save() is kept (rather than bulk_create)
+            # because Device.save() instantiates the interfaces from the device type templates.
+            switch1 = Device(
+                name=device_name1,
+                device_type=device_type,
+                role=device_role,
+                location=location,
+                status=active_status,
             )
+            switch1.validated_save()
+            self.logger.info("Created device", extra={"object": switch1})
+            if debug:
+                self.logger.debug(
+                    "Switch1 created with device_type=%s, role=%s, location=%s",
+                    device_type, device_role, location
+                )
 
-        switch2 = Device(
-            name=device_name2,
-            device_type=device_type,
-            role=device_role,
-            location=location,
-            status=active_status,
-        )
-        switch2.validated_save()
-        self.logger.info("Created device", extra={"object": switch2})
-        if debug:
-            self.logger.debug(
-                "Switch2 created with device_type=%s, role=%s, location=%s",
-                device_type, device_role, location
+            switch2 = Device(
+                name=device_name2,
+                device_type=device_type,
+                role=device_role,
+                location=location,
+                status=active_status,
             )
+            switch2.validated_save()
+            self.logger.info("Created device", extra={"object": switch2})
+            if debug:
+                self.logger.debug(
+                    "Switch2 created with device_type=%s, role=%s, location=%s",
+                    device_type, device_role, location
+                )
 
-        # Retrieve the "first" interface for each device, ordered by name.
-        # Raise an error if no interface is found on a device.
-        iface1 = switch1.interfaces.order_by("name").first()
-        if not iface1:
-            raise ValueError(f"No interface found on device {switch1.name}. Please create an interface before running this job.")
-
-        iface2 = switch2.interfaces.order_by("name").first()
-        if not iface2:
-            raise ValueError(f"No interface found on device {switch2.name}. Please create an interface before running this job.")
+            # Retrieve the "first" interface for each device, ordered by name.
+            # Raise an error if no interface is found on a device.
+            # Full rows are fetched on purpose: the interfaces become cable terminations, and
+            # cable validation reads fields such as type, device and cable, so restricting the
+            # query with .only() would trigger extra deferred-field queries.
+            iface1 = switch1.interfaces.order_by("name").first()
+            if not iface1:
+                raise ValueError(f"No interface found on device {switch1.name}. Please create an interface before running this job.")
 
-        if debug:
-            self.logger.debug("Retrieved first interface of switch1: %s", iface1)
-            self.logger.debug("Retrieved first interface of switch2: %s", iface2)
+            iface2 = switch2.interfaces.order_by("name").first()
+            if not iface2:
+                raise ValueError(f"No interface found on device {switch2.name}. Please create an interface before running this job.")
 
-        # Retrieve the Cable status ("Connected") as a Status instance.
-        cable_status = Status.objects.get(name="Connected")
-        if debug:
-            self.logger.debug("Cable status retrieved: %s", cable_status)
+            if debug:
+                self.logger.debug("Retrieved first interface of switch1: %s", iface1)
+                self.logger.debug("Retrieved first interface of switch2: %s", iface2)
 
-        # Connect the two interfaces with a cable.
-        cable = Cable(
-            termination_a=iface1,
-            termination_b=iface2,
-            status=cable_status,
-        )
-        cable.validated_save()
-        self.logger.info("Connected interfaces with cable", extra={"object": cable})
-        if debug:
-            self.logger.debug("Cable connected between %s and %s", iface1, iface2)
+            # Retrieve the Cable status ("Connected") as a Status instance.
+            cable_status = _status("Connected")
+            if debug:
+                self.logger.debug("Cable status retrieved: %s", cable_status)
 
-        # Ensure the parent IPAM prefix exists.
-        parent_prefix, _ = Prefix.objects.get_or_create(
-            prefix="10.0.0.0/8",
-            defaults={"description": "Parent prefix for switch interconnections", "status": active_status},
-        )
-        if debug:
-            self.logger.debug("Parent prefix ensured: %s", parent_prefix)
-
-        # Find the first available /31 subnet within 10.0.0.0/8.
-        parent_network = ipaddress.ip_network("10.0.0.0/8")
-        candidate_subnet_str = None
-        candidate_ip_a = None
-        candidate_ip_b = None
-
-        for candidate in parent_network.subnets(new_prefix=31):
-            # A /31 subnet has exactly 2 addresses.
-            ips = list(candidate)
-            ip_a = f"{ips[0]}/31"
-            ip_b = f"{ips[1]}/31"
-            # Check if either IP is already used.
-            if not IPAddress.objects.filter(address=ip_a).exists() and not IPAddress.objects.filter(address=ip_b).exists():
-                candidate_subnet_str = str(candidate)
-                candidate_ip_a = ip_a
-                candidate_ip_b = ip_b
+            # Connect the two interfaces with a cable.
+            cable = Cable(
+                termination_a=iface1,
+                termination_b=iface2,
+                status=cable_status,
+            )
+            cable.validated_save()
+            self.logger.info("Connected interfaces with cable", extra={"object": cable})
+            if debug:
+                self.logger.debug("Cable connected between %s and %s", iface1, iface2)
+
+            # Ensure the parent IPAM prefix exists, and lock its row until the transaction
+            # commits so concurrent runs of this job allocate /31s one at a time instead of
+            # racing for the same free subnet.
+            parent_prefix, _ = Prefix.objects.select_for_update().get_or_create(
+                prefix=_PARENT_PREFIX_STR,
+                defaults={"description": "Parent prefix for switch interconnections", "status": active_status},
+            )
+            if debug:
+                self.logger.debug("Parent prefix ensured: %s", parent_prefix)
+
+            # Find the first available /31 subnet within the parent network.
+            # Fetch every IP already allocated under the parent in a single query and
+            # reduce each one to the base address of the /31 it falls in.
+            used = set()
+            for host in IPAddress.objects.filter(host__net_host_contained=_PARENT_PREFIX_STR).values_list("host", flat=True):
+                used.add(int(ipaddress.IPv4Address(host)) & 0xFFFFFFFE)
+            if debug:
+                self.logger.debug("Found %d used /31 subnets in %s", len(used), _PARENT_NETWORK)
+
+            candidate_subnet_str = None
+            candidate_ip_a = None
+            candidate_ip_b = None
+
+            # Walk the used /31 bases in ascending order; the first gap from the start
+            # of the parent network is the first free /31. This is O(used) rather than
+            # O(address space), so a mostly empty parent is answered immediately.
+            base = int(_PARENT_NETWORK.network_address)
+            for used_base in sorted(used):
+                if used_base != base:
+                    break
+                base += 2
+
+            if base <= int(_PARENT_NETWORK.broadcast_address):
+                # A /31 is exactly its network address and the address after it.
+                network_address = ipaddress.IPv4Address(base)
+                candidate_subnet_str = f"{network_address}/31"
+                candidate_ip_a = candidate_subnet_str
+                candidate_ip_b = f"{network_address + 1}/31"
                 if debug:
                     self.logger.debug(
                         "Found available candidate subnet: %s with IPs %s and %s",
@@ -154,65 +188,55 @@ class CreateSwitchPair(Job):
                         candidate_ip_a,
                         candidate_ip_b
                     )
-                break
 
-        if candidate_subnet_str is None:
-            raise Exception("No available /31 subnet found in 10.0.0.0/8")
+            if candidate_subnet_str is None:
+                raise Exception(f"No available /31 subnet found in {_PARENT_PREFIX_STR}")
 
-        # Get or create the Prefix for the candidate subnet.
-        try:
-            subnet = Prefix.objects.get(prefix=candidate_subnet_str)
-            if debug:
-                self.logger.debug("Found existing subnet: %s", subnet)
-        except Prefix.DoesNotExist:
-            subnet = Prefix(
+            # Get or create the Prefix for the candidate subnet.
+            subnet, created = Prefix.objects.get_or_create(
                 prefix=candidate_subnet_str,
-                description="First available /31 subnet for switch interconnection",
-                status=active_status,
+                defaults={"description": "First available /31 subnet for switch interconnection", "status": active_status},
             )
-            subnet.full_clean()
-            subnet.save()
-            self.logger.info("Created /31 prefix", extra={"object": subnet})
+            if created:
+                self.logger.info("Created /31 prefix", extra={"object": subnet})
             if debug:
-                self.logger.debug("Created new subnet: %s", subnet)
-
-        # Create IPAddress instances for each interface using the candidate IPs.
-        ip1 = IPAddress(address=candidate_ip_a, status=active_status)
-        ip1.full_clean()
-        ip1.save()
-        # Associate the IP address with the interface via the many-to-many "interfaces" relation.
-        ip1.interfaces.add(iface1)
-        self.logger.info("Assigned IP to switch1 interface", extra={"object": ip1})
-        if debug:
-            self.logger.debug("Assigned IP %s to interface %s", ip1.address, iface1)
+                self.logger.debug("%s subnet: %s", "Created new" if created else "Found existing", subnet)
+
+            # Create IPAddress instances for each interface using the candidate IPs.
+            # full_clean() is skipped: the addresses come from a /31 verified free above, and
+            # IPAddress.save() still runs clean() to resolve the parent prefix.
+            ip1 = IPAddress(address=candidate_ip_a, status=active_status)
+            ip1.save()
+            # Associate the IP address with the interface via the many-to-many "interfaces" relation.
+            ip1.interfaces.add(iface1)
+            self.logger.info("Assigned IP to switch1 interface", extra={"object": ip1})
+            if debug:
+                self.logger.debug("Assigned IP %s to interface %s", ip1.address, iface1)
+
+            ip2 = IPAddress(address=candidate_ip_b, status=active_status)
+            ip2.save()
+            ip2.interfaces.add(iface2)
+            self.logger.info("Assigned IP to switch2 interface", extra={"object": ip2})
+            if debug:
+                self.logger.debug("Assigned IP %s to interface %s", ip2.address, iface2)
+
+            # Generate a CSV summary of the new devices, interfaces, and assigned IPs.
+            output_lines = ["device,interface,ip_address"]
+            # The objects were just created above, so reuse them rather than re-querying.
+            for switch, interface, ip_obj in ((switch1, iface1, ip1), (switch2, iface2, ip2)):
+                output_lines.append(f"{switch.name},{interface.name},{ip_obj.address}")
+                if debug:
+                    self.logger.debug(
+                        "Summary entry for %s: interface %s with IP %s",
+                        switch.name, interface.name, ip_obj.address
+                    )
 
-        ip2 = IPAddress(address=candidate_ip_b, status=active_status)
-        ip2.full_clean()
-        ip2.save()
-        ip2.interfaces.add(iface2)
-        self.logger.info("Assigned IP to switch2 interface", extra={"object": ip2})
-        if debug:
-            self.logger.debug("Assigned IP %s to interface %s", ip2.address, iface2)
-
-        # Generate a CSV summary of the new devices, interfaces, and assigned IPs.
-        output_lines = ["device,interface,ip_address"]
-        for switch in (switch1, switch2):
-            interface = switch.interfaces.order_by("name").first()
-            ip_obj = IPAddress.objects.filter(interfaces=interface).first()
-            ip_str = ip_obj.address if ip_obj else "None"
-            output_lines.append(f"{switch.name},{interface.name},{ip_str}")
             if debug:
                 self.logger.debug(
-                    "Summary entry for %s: interface %s with IP %s",
-                    switch.name, interface.name, ip_str
+                    "Job completed successfully. Output:\n%s",
+                    "\n".join(output_lines)
                 )
 
-        if debug:
-            self.logger.debug(
-                "Job completed successfully. Output:\n%s",
-                "\n".join(output_lines)
-            )
-
-        return "\n".join(output_lines)
+            return "\n".join(output_lines)
 
 register_jobs(CreateSwitchPair)